@@ -0,0 +1,112 @@
+'''
+Benchmark of MIDI output resilience to UI stalls.
+
+Touch events arrive every millisecond with their own timestamps. A simulated
+UI loop picks them up once per frame and dispatches them. Every few frames one
+of the handlers stalls the UI halfway through dispatch with a garbage
+collection pause and a grid rebuild's worth of busy work. The messages go
+either straight to an output whose writes block now and then, like a busy
+driver, or into the engine ring, where the engine process writes them to the
+same kind of output. Both paths send every message, the engine does not skip
+repeated values here. Each path reports the delay from touch event to output
+write under the same stalls, and the time the UI thread spent blocked in its
+MIDI calls, which is what the engine takes off the UI thread.
+
+    python bench/engine_stall.py [frames]
+'''
+
+import gc
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import midiengine
+from midiengine import MIDIJitter, MIDIRing, SlowOutput
+
+FRAME = 1 / 60
+EVENT = 0.001
+STALL_EVERY = 20
+STALL = 0.03
+SLOW = (100, 0.005)
+
+
+def stall():
+    garbage = [[i] for i in range(200000)]
+    del garbage
+    gc.collect()
+    end = time.perf_counter() + STALL
+    while time.perf_counter() < end:
+        pass
+
+
+class Blocked:
+    '''Time the UI thread spends inside MIDI calls.'''
+
+    def __init__(self, write):
+        self.write = write
+        self.calls = []
+
+    def __call__(self, *args):
+        start = time.perf_counter()
+        self.write(*args)
+        self.calls.append(time.perf_counter() - start)
+
+    def report(self):
+        calls = sorted(call * 1000 for call in self.calls)
+        return ('UI blocked in MIDI calls: {} calls, total {:.1f} ms, mean {:.4f} ms, '
+                'p99 {:.3f} ms, max {:.3f} ms').format(
+            len(calls), sum(calls), statistics.mean(calls),
+            calls[int(len(calls) * .99)], calls[-1])
+
+
+def ui_loop(frames, write):
+    start = next_event = time.monotonic()
+    for frame in range(frames):
+        now = time.monotonic()
+        events = []
+        while next_event <= now:
+            events.append(next_event)
+            next_event += EVENT
+        half = len(events) // 2
+        for i, event in enumerate(events):
+            if i == half and not frame % STALL_EVERY:
+                stall()
+            write(event, 0xE0, i % 128, 64)
+        time.sleep(max(0, start + (frame + 1) * FRAME - time.monotonic()))
+
+
+def main():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 600
+
+    print('inline:')
+    output = SlowOutput(*SLOW)
+    jitter = MIDIJitter(0)
+
+    def write(event, status, data1, data2):
+        jitter.add(event * 1000, time.monotonic() * 1000)
+        output.write_short(status, data1, data2)
+
+    blocked = Blocked(write)
+    ui_loop(frames, blocked)
+    print(jitter.report())
+    print(blocked.report())
+
+    print('engine:')
+    ring = MIDIRing(1024)
+    engine = midiengine.Engine(ring, None, jitterlog=True, slow=SLOW, skip=False)
+    engine.wait_ready()
+    blocked = Blocked(ring.push)
+    ui_loop(frames, blocked)
+    time.sleep(0.1)
+    engine.stop()
+    print(blocked.report())
+    print('ring: {occupancy}/{capacity} queued, high water {high_water}, '
+          '{overruns} overruns, {sent} sent, {skipped} repeats skipped'.format(**ring.stats()))
+    ring.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+'''
+Key touch handler time with highlighting immediate, deferred and off.
+
+Slides a touch across a row of keys, several move events per key, the way a
+glissando arrives, with a MIDI backend that does nothing. Handler time is
+measured separately from the once per frame highlight update of the deferred
+mode. Needs Kivy and a display, like the app.
+
+    python bench/highlight.py [passes]
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('KIVY_NO_ARGS', '1')
+
+import main as mastergrid
+from kivy.clock import Clock
+from kivy.uix.widget import Widget
+
+KEYS = 36
+WIDTH = 40
+MOVES = 4
+MOVES_PER_FRAME = 2
+
+
+class NullMIDI:
+    latency = 0
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class Touch:
+    def __init__(self, uid, x, y):
+        self.uid = uid
+        self.ud = {}
+        self.profile = []
+        self.opos = (x, y)
+        self.move(x, y)
+
+    def move(self, x, y):
+        self.x, self.y = x, y
+        self.pos = (x, y)
+        self.time_update = self.time_end = time.time()
+
+
+def glissando(keys, uid):
+    handlers = frame = 0.0
+    touch = Touch(uid, WIDTH / 2, WIDTH / 2)
+    start = time.perf_counter()
+    keys[0].on_touch_down(touch)
+    handlers += time.perf_counter() - start
+    moves = 0
+    for key in keys:
+        for step in range(MOVES):
+            touch.move(key.x + (step + .5) * WIDTH / MOVES, WIDTH / 2)
+            start = time.perf_counter()
+            key.on_touch_move(touch)
+            handlers += time.perf_counter() - start
+            moves += 1
+            if not moves % MOVES_PER_FRAME:
+                start = time.perf_counter()
+                mastergrid.app.apply_highlights()
+                frame += time.perf_counter() - start
+    start = time.perf_counter()
+    keys[-1].on_touch_up(touch)
+    handlers += time.perf_counter() - start
+    start = time.perf_counter()
+    mastergrid.app.apply_highlights()
+    frame += time.perf_counter() - start
+    return handlers, frame, moves + 2
+
+
+def main():
+    passes = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+
+    app = mastergrid.app = mastergrid.MasterGrid()
+    app.config = app.load_config()
+    app.config.set('Expression', 'Pitchbend', False)
+    app.controls = Widget(pos=(-1000, -1000), size=(1, 1))
+    app.grid = Widget(width=KEYS * WIDTH)
+    app.dirty = {}
+    app.lit = set()
+    app.trigger_highlights = Clock.create_trigger(app.apply_highlights)
+    mastergrid.midi = NullMIDI()
+
+    keys = []
+    for i in range(KEYS):
+        key = mastergrid.Key(note=60 + i, row=0, text='C',
+                             color=[0, 0, 0, 1], background_color=[1, 1, 1, 1])
+        key.pos = (i * WIDTH, 0)
+        key.size = (WIDTH, WIDTH)
+        keys.append(key)
+
+    for mode in ('Immediate', 'Deferred', 'Off'):
+        app.highlight_mode = mode
+        app.clear_highlights()
+        handlers = frame = 0.0
+        events = 0
+        for uid in range(passes):
+            h, f, n = glissando(keys, uid)
+            handlers += h
+            frame += f
+            events += n
+        print('{:9} handler {:.1f} us per event, highlight update {:.1f} us per event'.format(
+            mode, handlers / events * 1e6, frame / events * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+'''
+Timing accuracy of the sequencer while the UI thread is busy.
+
+Arpeggiates three held notes as 16th notes at 200 BPM against an output that
+behaves like PortMidi: a message written with a timestamp sounds at the
+timestamp plus the latency, or as soon as it is written if that is already
+past. A second thread keeps the interpreter busy like a UI building a grid.
+Reports how far each note-on sounded from its deadline, and how much that
+varies, without an output latency and with one plus the default margin.
+
+    python bench/sequencer_timing.py [seconds]
+'''
+
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from midiengine import PortClock
+from sequencer import Sequencer
+
+# Default Sequencer Lookahead setting, in milliseconds
+MARGIN = 20
+
+
+class TimedOutput:
+    '''Records when each note-on would sound, relative to its deadline.
+
+    Emulates PortMidi: a millisecond clock with its own origin, and messages
+    that sound at their timestamp plus the latency, or when written if that
+    is already past. Timestamps come from the same PortClock conversion the
+    app uses.
+    '''
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.origin = time.monotonic() - random.random()
+        self.clock = PortClock(self.time_ms)
+        self.errors = []
+
+    def time_ms(self):
+        return int((time.monotonic() - self.origin) * 1000)
+
+    def timestamp_for(self, deadline):
+        return self.clock.timestamp_for(deadline, self.latency)
+
+    def write_at(self, timestamp, status, data1=0, data2=0):
+        now = time.monotonic()
+        if status & 0xF0 != 0x90:
+            return
+        deadline = self.pending.pop(0)
+        if self.latency:
+            sounds = max(now, self.origin + (timestamp + self.latency) / 1000)
+        else:
+            sounds = now
+        self.errors.append((sounds - deadline) * 1000)
+
+
+class Deadlines(Sequencer):
+    '''Sequencer that tells the output which deadline each note-on was for.'''
+
+    def send(self, deadline, status, data1, data2):
+        if status & 0xF0 == 0x90:
+            self.midi.pending.append(deadline)
+        super().send(deadline, status, data1, data2)
+
+
+def busy(stop):
+    while not stop.is_set():
+        keys = [[note, note % 12, [1, 1, 1, 1]] for note in range(1300)]
+        sum(len(key) for key in keys)
+
+
+def measure(seconds, latency):
+    output = TimedOutput(latency)
+    output.pending = []
+    lookahead = (latency + MARGIN) / 1000 if latency else 0
+    sequencer = Deadlines(output, mode='Arp', bpm=200, rate=4, gate=50, lookahead=lookahead)
+    for uid, note in enumerate((60, 64, 67)):
+        sequencer.press(uid, note, 100)
+    stop = threading.Event()
+    ui = threading.Thread(target=busy, args=(stop,))
+    ui.start()
+    sequencer.start()
+    time.sleep(seconds)
+    sequencer.stop()
+    sequencer.join()
+    stop.set()
+    ui.join()
+
+    errors = output.errors
+    mean = statistics.mean(errors)
+    deviations = sorted(abs(e - mean) for e in errors)
+    print('latency {:2} ms: {} notes, offset from deadline mean {:.3f} ms, '
+          'jitter stdev {:.3f} ms, p99 {:.3f} ms, max {:.3f} ms'.format(
+              latency, len(errors), mean, statistics.pstdev(errors),
+              deviations[int(len(deviations) * .99)], deviations[-1]))
+    print(' ', sequencer.report().replace('\n', '\n  '))
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    for latency in (0, 10):
+        measure(seconds, latency)
+
+
+if __name__ == '__main__':
+    main()
@@ -20,11 +20,15 @@ along with MasterGrid. If not, see <http://www.gnu.org/licenses/>
 '''
 
 import os
+import threading
+import time
 import kivy
 from functools import partial
 from kivy.app import App
 from kivy.clock import Clock
+from kivy.core.text import Label as CoreLabel
 from kivy.core.window import Window
+from kivy.graphics import Color, Rectangle
 from kivy.event import EventDispatcher
 from kivy.multistroke import xrange
 from kivy.uix.widget import Widget
@@ -41,11 +45,17 @@ from kivy.uix.colorpicker import ColorPicker
 from kivy.properties import BooleanProperty, ObjectProperty, NumericProperty, StringProperty
 from kivy.utils import rgba
 from kivy.utils import platform
+from profiler import Profiler, enabled
+from sequencer import Sequencer
 
 if platform == 'android':
     from jnius import autoclass
 else:
     import pygame.midi
+    # Shared memory is not available on Android, which uses VirtualMIDI instead
+    import midiengine
+    from midiengine import MIDIJitter, MIDIRing, PortClock
+    from router import Router, parse_destinations
 
 global app
 global midi
@@ -56,60 +66,106 @@ class PyGameMIDI(EventDispatcher):
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        # Held by every write and by reopening, the sequencer writes from its own thread
+        self.lock = threading.Lock()
+        self.midi = None
+        self.jitter = None
         self.select_device()
 
     def select_device(self):
-        c = pygame.midi.get_count()
-        id_device_from_settings = -1
-        for i in reversed(range(c)):
-            if pygame.midi.get_device_info(i)[1].decode() == app.config.get('MIDI', 'Device'):
-                id_device_from_settings = i
-
-        if id_device_from_settings != -1:
-            midi_device = id_device_from_settings
+        with self.lock:
+            self.close_output()
+            self.open_output()
+
+    def load_settings(self):
+        # With a non-zero latency PortMidi delivers each message at its
+        # timestamp plus the latency, so touch timing survives UI jitter.
+        self.scheduled = app.config.getboolean('MIDI', 'Scheduled')
+        self.latency = app.config.getint('MIDI', 'Latency') if self.scheduled else 0
+        self.timestamp = 0
+        self.clock = PortClock(pygame.midi.time)
+        if app.config.getboolean('MIDI', 'JitterLog'):
+            self.jitter = MIDIJitter(self.latency)
+
+    def open_output(self):
+        self.load_settings()
+        self.midi = midiengine.open_output(app.config.get('MIDI', 'Device'), self.latency)
+
+    def close_output(self):
+        if self.jitter is not None:
+            print(self.jitter.report())
+            self.jitter = None
+        if self.midi is not None:
+            self.midi.close()
+            self.midi = None
+
+    def set_time(self, event_time=None):
+        # Convert a Kivy event time (seconds, time.time() based) to PortMidi time.
+        if event_time is None:
+            self.timestamp = 0
         else:
-            midi_device = pygame.midi.get_default_output_id()
+            self.timestamp = self.event_timestamp(time.monotonic() - (time.time() - event_time))
 
-        if pygame.midi.get_device_info(midi_device)[4] == 1:
-            print('Error: Unable to open MIDI device - Already in use!')
+    def event_timestamp(self, event):
+        return max(1, int(self.clock.at(event)))
 
-        self.midi = pygame.midi.Output(midi_device)
+    def timestamp_for(self, deadline):
+        # PortMidi time at which a message sounds at a time.monotonic() deadline
+        return self.clock.timestamp_for(deadline, self.latency)
+
+    def write_short(self, status, data1=0, data2=0):
+        self.write_at(self.timestamp, status, data1, data2)
+
+    def write_at(self, timestamp, status, data1=0, data2=0):
+        with self.lock:
+            self.record(timestamp)
+            self.send(timestamp, status, data1, data2)
+
+    def record(self, timestamp):
+        if self.jitter is not None:
+            self.jitter.add(timestamp, pygame.midi.time())
+
+    def send(self, timestamp, status, data1, data2):
+        if self.scheduled and timestamp:
+            self.midi.write([[[status, data1, data2], timestamp]])
+        else:
+            self.midi.write_short(status, data1, data2)
 
     def set_instrument(self, instrument, channel):
-        self.midi.set_instrument(instrument, channel=channel)
+        self.write_short(0xC0 + channel, instrument)
 
     def note_on(self, note, velocity, channel):
-        self.midi.note_on(note, int(velocity), channel)
+        self.write_short(0x90 + channel, note, int(velocity))
 
     def note_off(self, note, channel):
-        self.midi.note_off(note, 0, channel)
+        self.write_short(0x80 + channel, note, 0)
 
     def mod(self, channel, value):
-        self.midi.write_short(0xB0 + channel, 1, value)
+        self.write_short(0xB0 + channel, 1, value)
 
     def breath(self, channel, value):
-        self.midi.write_short(0xB0 + channel, 2, value)
+        self.write_short(0xB0 + channel, 2, value)
 
     def foot(self, channel, value):
-        self.midi.write_short(0xB0 + channel, 4, value)
+        self.write_short(0xB0 + channel, 4, value)
 
     def expression(self, channel, value):
-        self.midi.write_short(0xB0 + channel, 11, value)
+        self.write_short(0xB0 + channel, 11, value)
 
     def pitchbend(self, channel, value):
-        self.midi.write_short(0xE0 + channel, value - int(value / 128) * 128, int(value / 128))
+        self.write_short(0xE0 + channel, value - int(value / 128) * 128, int(value / 128))
 
     def set_pitchbend_range(self, value):
         for channel in range(16):
-            self.midi.write_short(0xB0 + channel, 100, 0)
-            self.midi.write_short(0xB0 + channel, 101, 0)
-            self.midi.write_short(0xB0 + channel, 6, app.config.getint('Expression', 'PitchbendRange'))
+            self.write_short(0xB0 + channel, 100, 0)
+            self.write_short(0xB0 + channel, 101, 0)
+            self.write_short(0xB0 + channel, 6, app.config.getint('Expression', 'PitchbendRange'))
 
     def poly_aftertouch(self, channel, note, pressure):
-        self.midi.write_short(0xA0 + channel, note, int(pressure))
+        self.write_short(0xA0 + channel, note, int(pressure))
 
     def channel_aftertouch(self, channel, note, pressure):
-        self.midi.write_short(0xD0 + channel, int(pressure))
+        self.write_short(0xD0 + channel, int(pressure))
 
     def aftertouch(self, channel, note, pressure):
         if app.config.get('Expression', 'PolyAftertouch'):
@@ -118,7 +174,7 @@ class PyGameMIDI(EventDispatcher):
             self.channel_aftertouch(channel, note, pressure)
 
     def reverb(self, channel, value):
-        self.midi.write_short(0xB0 + channel, 91, value)
+        self.write_short(0xB0 + channel, 91, value)
 
     def set_reverb(self, value):
         if app.config.getboolean('Expression', 'Pitchbend'):
@@ -128,28 +184,156 @@ class PyGameMIDI(EventDispatcher):
             self.reverb(app.config.getint('MIDI', 'Channel'), value)
 
     def reset(self, channel):
-        self.midi.write_short(0xB0 + channel, 123, 0)
+        self.write_short(0xB0 + channel, 123, 0)
 
     def panic(self):
         for channel in range(16):
             self.reset(channel)
 
+    def close(self):
+        with self.lock:
+            self.close_output()
+
+
+class RouterMIDI(PyGameMIDI):
+    '''Sends MIDI messages to several destinations, each with its own queue.'''
+
+    router = None
+
+    def open_output(self):
+        self.load_settings()
+        self.router = Router(parse_destinations(app.config.get('MIDI', 'Destinations')), self.latency)
+
+    def write_at(self, timestamp, status, data1=0, data2=0):
+        # Dispatch outside the lock, a destination may wait for room in its queue
+        with self.lock:
+            self.record(timestamp)
+            router = self.router
+        router.dispatch(timestamp if self.scheduled else 0, status, data1, data2)
+
+    def close_output(self):
+        super().close_output()
+        if self.router is not None:
+            self.router.close()
+            print(self.router.report())
+            self.router = None
+
+
+class EngineMIDI(PyGameMIDI):
+    '''Hands MIDI messages to the engine process through a shared memory ring.'''
+
+    ring = None
+
+    def open_output(self):
+        self.load_settings()
+        # The engine writes the messages, so it keeps the jitter log
+        jitterlog, self.jitter = self.jitter is not None, None
+        self.ring = MIDIRing(app.config.getint('MIDI', 'RingSize'))
+        self.engine = midiengine.Engine(self.ring, app.config.get('MIDI', 'Device'),
+                                        self.latency, jitterlog)
+        if not self.engine.wait_ready():
+            self.fall_back()
+
+    def fall_back(self):
+        # Nothing drains the ring without the engine, send from this process instead
+        print('Error: MIDI engine process is not running - sending MIDI from the UI process')
+        self.close_output()
+        super().open_output()
+
+    def event_timestamp(self, event):
+        # The engine has its own PortMidi clock, share time.monotonic() instead
+        if self.ring is None:
+            return super().event_timestamp(event)
+        return event
+
+    def timestamp_for(self, deadline):
+        if self.ring is None:
+            return super().timestamp_for(deadline)
+        return deadline - self.latency / 1000
+
+    def send(self, timestamp, status, data1, data2):
+        if self.ring is None:
+            super().send(timestamp, status, data1, data2)
+        elif not self.ring.push(timestamp, status, data1, data2) and not self.engine.alive():
+            self.fall_back()
+            super().send(0, status, data1, data2)
+
+    def stats(self):
+        return self.ring.stats()
+
+    def close_output(self):
+        super().close_output()
+        if self.ring is None:
+            return
+        self.engine.stop()
+        print('MIDI engine: {occupancy}/{capacity} queued, high water {high_water}, '
+              '{overruns} overruns, {sent} sent, {skipped} repeats skipped'.format(**self.stats()))
+        self.ring.close()
+        self.ring = None
+
+
+class CaptionAtlas:
+    '''White note name textures shared by all keys, tinted per key when drawn.'''
+    font_size = None
+    textures = {}
+
+    @classmethod
+    def get(cls, text, font_size):
+        if font_size != cls.font_size:
+            cls.font_size = font_size
+            cls.textures = {}
+        texture = cls.textures.get(text)
+        if texture is None:
+            label = CoreLabel(text=text, font_size=font_size, color=(1, 1, 1, 1))
+            label.refresh()
+            texture = cls.textures[text] = label.texture
+        return texture
+
 
 class Key(Button):
     note = NumericProperty()
     row = NumericProperty()
+    caption = None
 
     def __init__(self, **kwargs):
         super().__init__()
         self.note = kwargs.get('note')
         self.row = kwargs.get('row')
-        self.text = kwargs.get('text')
+        # The caption is drawn from the shared atlas instead of Button.text,
+        # which would render a texture of its own for every key
+        texture = CaptionAtlas.get(kwargs.get('text'), self.font_size)
+        with self.canvas.after:
+            self.caption_color = Color(*kwargs.get('color'))
+            self.caption = Rectangle(texture=texture, size=texture.size)
         self.color = kwargs.get('color')
         self.background_color = kwargs.get('background_color')
         self.key_color_normal = self.background_color
         self.text_color_normal = self.color
         self.highlight = rgba(app.config.get('Grid', 'Highlight'))
 
+    def show_highlight(self, highlighted):
+        if highlighted:
+            self.background_color = self.highlight
+            self.color = [0, 0, 0, 1]
+        else:
+            self.background_color = self.key_color_normal
+            self.color = self.text_color_normal
+
+    def on_color(self, instance, value):
+        if self.caption is not None:
+            self.caption_color.rgba = value
+
+    def on_pos(self, instance, value):
+        self.place_caption()
+
+    def on_size(self, instance, value):
+        self.place_caption()
+
+    def place_caption(self):
+        if self.caption is not None:
+            width, height = self.caption.size
+            self.caption.pos = (int(self.center_x - width / 2), int(self.center_y - height / 2))
+
     def pressure(self, touch):
         velocity = app.config.getint('MIDI', 'Volume')
         sens = app.config.getint('Expression', 'Sensitivity')
@@ -168,6 +352,15 @@ class Key(Button):
         if not self.collide_point(*touch.pos):
             return super().on_touch_down(touch)
 
+        if app.sequencer is not None and app.sequencer.active:
+            app.sequencer.press(touch.uid, self.note, self.pressure(touch))
+            touch.ud['note'] = self.note
+            touch.ud['sequenced'] = True
+            app.set_highlight(self, True)
+            touch.ud['key'] = self
+            return
+
+        app.stamp(touch.time_update)
         velocity = self.pressure(touch)
         touch.ud['note'] = touch.ud['prev'] = self.note
         touch.ud['row'] = self.row
@@ -178,9 +371,9 @@ class Key(Button):
             midi.pitchbend(channel, 8192)
         midi.note_on(self.note, velocity, channel)
 
-        self.background_color = self.highlight
-        self.color = [0, 0, 0, 1]
+        app.set_highlight(self, True)
         touch.ud['key'] = self
+        app.stamp(None)
 
     def on_touch_up(self, touch):
         if app.grid_disabled or 'note' not in touch.ud:
@@ -189,14 +382,20 @@ class Key(Button):
         if not self.collide_point(*touch.pos):
             return super().on_touch_up(touch)
 
+        if 'sequenced' in touch.ud:
+            app.sequencer.release(touch.uid)
+            app.set_highlight(self, False)
+            return
+
+        app.stamp(touch.time_end)
         channel = app.get_channel(touch)
         if app.config.getboolean('Expression', 'Pitchbend'):
             app.free_channel(channel)
 
         midi.note_off(touch.ud['note'], channel)
 
-        self.background_color = self.key_color_normal
-        self.color = self.text_color_normal
+        app.set_highlight(self, False)
+        app.stamp(None)
 
     def on_touch_move(self, touch):
         if app.grid_disabled or 'note' not in touch.ud:
@@ -205,6 +404,15 @@ class Key(Button):
         if not self.collide_point(*touch.pos) or app.controls.collide_point(*touch.opos):
             return super().on_touch_move(touch)
 
+        if 'sequenced' in touch.ud:
+            if touch.ud['key'] != self:
+                app.sequencer.press(touch.uid, self.note, self.pressure(touch))
+                app.set_highlight(touch.ud['key'], False)
+                app.set_highlight(self, True)
+                touch.ud['key'] = self
+            return
+
+        app.stamp(touch.time_update)
         channel = app.get_channel(touch)
         note = touch.ud['note']
         velocity = self.pressure(touch)
@@ -241,11 +449,10 @@ class Key(Button):
             midi.aftertouch(channel, self.note, velocity)
 
         if touch.ud['key'] != self:
-            touch.ud['key'].background_color = touch.ud['key'].key_color_normal
-            touch.ud['key'].color = touch.ud['key'].text_color_normal
-            self.background_color = self.highlight
-            self.color = [0, 0, 0, 1]
+            app.set_highlight(touch.ud['key'], False)
+            app.set_highlight(self, True)
             touch.ud['key'] = self
+        app.stamp(None)
 
 
 class Sonome(GridLayout):
@@ -458,6 +665,8 @@ class Controls(BoxLayout):
             midi.mod(app.config.getint('MIDI', 'Channel'), value)
 
     def panic(self, button):
+        if app.sequencer is not None:
+            app.sequencer.clear()
         if platform == 'android':
             midi.sendMIDI(-1, 0xB0, 123, 0)
         else:
@@ -543,6 +752,27 @@ class SettingRange(SettingItem):
         elif self.key == 'Instrument':
             smin = 0
             smax = 127
+        elif self.key == 'Latency':
+            smin = 0
+            smax = 100
+        elif self.key == 'BPM':
+            smin = 40
+            smax = 300
+        elif self.key == 'Rate':
+            smin = 1
+            smax = 8
+        elif self.key == 'Swing':
+            smin = 0
+            smax = 75
+        elif self.key == 'Gate':
+            smin = 5
+            smax = 100
+        elif self.key == 'Lookahead':
+            smin = 0
+            smax = 100
+        elif self.key == 'FrameBudget':
+            smin = 5
+            smax = 100
         elif self.key == 'PitchbendRange':
             smin = 0
             smax = 64
@@ -642,6 +872,9 @@ class MasterGrid(App):
     channels = [[c, None] for c in range(16)]
     lastchannel = 0
     grid_disabled = False
+    sequencer = None
+    profiler = None
+    highlight_mode = 'Deferred'
 
     def get_channel(self, touch):
         if self.config.getboolean('Expression', 'Pitchbend'):
@@ -667,6 +900,66 @@ class MasterGrid(App):
     def free_channel(self, channel):
         self.channels[channel][1] = None
 
+    def sequencer_settings(self):
+        return dict(channel=self.config.getint('MIDI', 'Channel'),
+                    mode=self.config.get('Sequencer', 'Mode'),
+                    pattern=self.config.get('Sequencer', 'Pattern'),
+                    bpm=self.config.getint('Sequencer', 'BPM'),
+                    rate=self.config.getint('Sequencer', 'Rate'),
+                    swing=self.config.getint('Sequencer', 'Swing'),
+                    gate=self.config.getint('Sequencer', 'Gate'),
+                    lookahead=self.sequencer_lookahead())
+
+    def sequencer_lookahead(self):
+        # PortMidi queues future timestamps, so notes can be handed over earlier
+        # than one output latency ahead. Without Scheduled output it ignores them.
+        if not midi.latency:
+            return 0
+        return (midi.latency + self.config.getint('Sequencer', 'Lookahead')) / 1000
+
+    def set_profiling(self, on):
+        if on and self.profiler is None:
+            self.profiler = Profiler(budget=self.config.getint('Debug', 'FrameBudget'))
+            self.profiler.start()
+            Clock.schedule_interval(self.profiler.frame_end, 0)
+        elif not on and self.profiler is not None:
+            Clock.unschedule(self.profiler.frame_end)
+            self.profiler.stop()
+            print(self.profiler.report())
+            print('Profiler: wrote {} and {}'.format(*self.profiler.write(self.user_data_dir)))
+            self.profiler = None
+
+    def set_highlight(self, key, highlighted):
+        # Deferred highlights are applied once per frame, off the MIDI path
+        if self.highlight_mode == 'Deferred':
+            self.dirty[key] = highlighted
+            self.trigger_highlights()
+        elif self.highlight_mode == 'Immediate':
+            self.show_highlight(key, highlighted)
+
+    def apply_highlights(self, *args):
+        dirty, self.dirty = self.dirty, {}
+        for key, highlighted in dirty.items():
+            self.show_highlight(key, highlighted)
+
+    def show_highlight(self, key, highlighted):
+        key.show_highlight(highlighted)
+        if highlighted:
+            self.lit.add(key)
+        else:
+            self.lit.discard(key)
+
+    def clear_highlights(self):
+        for key in set(self.dirty) | self.lit:
+            key.show_highlight(False)
+        self.dirty = {}
+        self.lit = set()
+
+    def stamp(self, event_time):
+        # Touch down and move pass time_update, touch up passes time_end
+        if platform != 'android':
+            midi.set_time(event_time)
+
     def build_controls(self):
         self.controls = Controls(orientation='horizontal', size_hint=(1, .064))
 
@@ -687,7 +980,21 @@ class MasterGrid(App):
                 self.server = midi.MIDIServer
         else:
             pygame.midi.init()
-            midi = PyGameMIDI()
+            if self.config.get('MIDI', 'Destinations').strip():
+                midi = RouterMIDI()
+            elif self.config.getboolean('MIDI', 'Engine'):
+                midi = EngineMIDI()
+            else:
+                midi = PyGameMIDI()
+            self.sequencer = Sequencer(midi, **self.sequencer_settings())
+            self.sequencer.start()
+
+        self.highlight_mode = self.config.get('Grid', 'HighlightMode')
+        self.dirty = {}
+        self.lit = set()
+        self.trigger_highlights = Clock.create_trigger(self.apply_highlights)
+        self.set_profiling(self.config.getboolean('Debug', 'Profile')
+                           or enabled(os.environ.get('MASTERGRID_PROFILE')))
 
         self.build_controls()
         self.build_grid()
@@ -706,6 +1013,8 @@ class MasterGrid(App):
         self.root.add_widget(self.controls)
 
     def resize_grid(self):
+        self.dirty = {}
+        self.lit = set()
         self.root.remove_widget(self.grid)
         self.build_grid()
         self.root.add_widget(self.grid)
@@ -716,6 +1025,12 @@ class MasterGrid(App):
         config.setdefault('MIDI', 'Channel', 0)
         config.setdefault('MIDI', 'Volume', 127)
         config.setdefault('MIDI', 'Instrument', 0)
+        config.setdefault('MIDI', 'Scheduled', False)
+        config.setdefault('MIDI', 'Latency', 10)
+        config.setdefault('MIDI', 'JitterLog', False)
+        config.setdefault('MIDI', 'Engine', False)
+        config.setdefault('MIDI', 'RingSize', 1024)
+        config.setdefault('MIDI', 'Destinations', '')
         config.adddefaultsection('Expression')
         config.setdefault('Expression', 'Pitchbend', True)
         config.setdefault('Expression', 'PitchbendRange', 64)
@@ -732,6 +1047,18 @@ class MasterGrid(App):
         config.setdefault('Grid', 'Rows', 10)
         config.setdefault('Grid', 'Keys', 36)
         config.setdefault('Grid', 'Highlight', '#8080ffff')
+        config.setdefault('Grid', 'HighlightMode', 'Deferred')
+        config.adddefaultsection('Sequencer')
+        config.setdefault('Sequencer', 'Mode', 'Off')
+        config.setdefault('Sequencer', 'Pattern', 'Up')
+        config.setdefault('Sequencer', 'BPM', 120)
+        config.setdefault('Sequencer', 'Rate', 4)
+        config.setdefault('Sequencer', 'Swing', 0)
+        config.setdefault('Sequencer', 'Gate', 50)
+        config.setdefault('Sequencer', 'Lookahead', 20)
+        config.adddefaultsection('Debug')
+        config.setdefault('Debug', 'Profile', False)
+        config.setdefault('Debug', 'FrameBudget', 20)
 
     def build_settings(self, settings):
         settings.register_type('midi', SettingMIDI)
@@ -743,6 +1070,11 @@ class MasterGrid(App):
             { "type": "range", "title": "Default channel", "desc": "Default MIDI channel", "section": "MIDI", "key": "Channel"},
             { "type": "range", "title": "Volume", "desc": "Default MIDI note velocity (0-127)", "section": "MIDI", "key": "Volume"},
             { "type": "range", "title": "Instrument", "desc": "MIDI instrument number (0-127)", "section": "MIDI", "key": "Instrument"},
+            { "type": "bool", "title": "Scheduled output", "desc": "Timestamp notes with their touch time to remove jitter", "section": "MIDI", "key": "Scheduled"},
+            { "type": "range", "title": "Latency", "desc": "Scheduled output latency in milliseconds", "section": "MIDI", "key": "Latency"},
+            { "type": "bool", "title": "Jitter log", "desc": "Print MIDI timing statistics on exit", "section": "MIDI", "key": "JitterLog"},
+            { "type": "bool", "title": "MIDI engine process", "desc": "Send MIDI from a separate process (restart to apply)", "section": "MIDI", "key": "Engine"},
+            { "type": "string", "title": "MIDI destinations", "desc": "Send to several devices: name, channels, notes, policy entries separated by | (restart to turn on or off)", "section": "MIDI", "key": "Destinations"},
             { "type": "bool", "title": "Pitchbend", "desc": "Continuous pitchbend", "section": "Expression", "key": "Pitchbend"},
             { "type": "range", "title": "Pitchbend Range", "desc": "Pitchbend range in semitones", "section": "Expression", "key": "PitchbendRange"},
             { "type": "bool", "title": "Aftertouch", "desc": "Aftertouch expression", "section": "Expression", "key": "Aftertouch"},
@@ -756,7 +1088,17 @@ class MasterGrid(App):
             { "type": "range", "title": "Starting octave", "desc": "Octave of bottom left note", "section": "Grid", "key": "Octave"},
             { "type": "range", "title": "Rows", "desc": "Number of rows", "section": "Grid", "key": "Rows"},
             { "type": "range", "title": "Keys", "desc": "Semitones per row", "section": "Grid", "key": "Keys"},
-            { "type": "color", "title": "Highlight color", "desc": "Key highlight color", "section": "Grid", "key": "Highlight"}
+            { "type": "color", "title": "Highlight color", "desc": "Key highlight color", "section": "Grid", "key": "Highlight"},
+            { "type": "options", "title": "Highlighting", "desc": "Deferred updates keys once per frame, Off saves power", "section": "Grid", "key": "HighlightMode", "options": ["Immediate", "Deferred", "Off"]},
+            { "type": "options", "title": "Sequencer", "desc": "Arpeggiate held keys or latch tapped keys into a loop, turn on Scheduled output for steady timing", "section": "Sequencer", "key": "Mode", "options": ["Off", "Arp", "Latch"]},
+            { "type": "options", "title": "Arpeggio pattern", "desc": "Order of held notes (Arp only)", "section": "Sequencer", "key": "Pattern", "options": ["Up", "Down", "UpDown", "Random"]},
+            { "type": "range", "title": "Tempo", "desc": "Beats per minute", "section": "Sequencer", "key": "BPM"},
+            { "type": "range", "title": "Rate", "desc": "Steps per beat, 4 for 16th notes", "section": "Sequencer", "key": "Rate"},
+            { "type": "range", "title": "Swing", "desc": "Delay of every second step in percent of a step", "section": "Sequencer", "key": "Swing"},
+            { "type": "range", "title": "Gate", "desc": "Note length in percent of a step", "section": "Sequencer", "key": "Gate"},
+            { "type": "range", "title": "Lookahead", "desc": "Milliseconds notes are sent ahead of the output latency (Scheduled output only)", "section": "Sequencer", "key": "Lookahead"},
+            { "type": "bool", "title": "Profiler", "desc": "Sample the UI thread and write flame graph stacks when turned off", "section": "Debug", "key": "Profile"},
+            { "type": "range", "title": "Frame budget", "desc": "Frames slower than this many milliseconds are saved by the profiler", "section": "Debug", "key": "FrameBudget"}
         ]''')
 
     def display_settings(self, settings):
@@ -768,8 +1110,21 @@ class MasterGrid(App):
         App.close_settings(self, largs)
 
     def on_config_change(self, config, section, key, value):
-        if key == 'Device':
+        if key in ('Device', 'Destinations', 'Scheduled', 'Latency', 'JitterLog'):
             midi.select_device()
+            if self.sequencer is not None:
+                self.sequencer.configure(**self.sequencer_settings())
+        elif key == 'HighlightMode':
+            self.highlight_mode = value
+            self.clear_highlights()
+        elif key == 'Profile':
+            self.set_profiling(self.config.getboolean('Debug', 'Profile'))
+        elif key == 'FrameBudget':
+            if self.profiler is not None:
+                self.profiler.budget = self.config.getint('Debug', 'FrameBudget')
+        elif section == 'Sequencer' or key == 'Channel':
+            if self.sequencer is not None:
+                self.sequencer.configure(**self.sequencer_settings())
         elif key == 'Layout':
             self.resize()
         elif key == 'Rows':
@@ -796,8 +1151,13 @@ if __name__ in ('__main__', '__android__'):
         app = MasterGrid()
         app.run()
     finally:
+        app.set_profiling(False)
         if platform == 'android':
             midi.tearDownMIDIServer(app.server)
         else:
-            midi.midi.close()
+            app.sequencer.stop()
+            app.sequencer.join(1)
+            if app.config.getboolean('MIDI', 'JitterLog'):
+                print(app.sequencer.report())
+            midi.close()
         app.config.write()
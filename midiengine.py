@@ -0,0 +1,402 @@
+'''
+MasterGrid
+Copyright (c) 2018 Robert Oscilowski
+
+MIDI engine process
+
+The UI process writes fixed-size event records into a shared memory ring
+buffer and a separate engine process owns the MIDI output, so garbage
+collection pauses and texture uploads in the UI do not stall note output.
+The engine runs this module as its own script, so it never imports Kivy
+or inherits the state of the UI process:
+
+    python midiengine.py RING CAPACITY [--device NAME] [--latency MS] [--jitterlog]
+
+The --slow option replaces the device with a simulated busy driver and
+--no-skip sends repeated controller values too, for bench/engine_stall.py.
+
+When the ring fills up only controller, pitchbend and aftertouch messages
+are dropped. The last quarter of the ring is kept free for notes and
+resets, which wait briefly for room when even that is used up.
+
+MasterGrid is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MasterGrid is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MasterGrid. If not, see <http://www.gnu.org/licenses/>
+'''
+
+import argparse
+import collections
+import os
+import struct
+import subprocess
+import sys
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+# head, tail, overruns, high water, sent, skipped, stop, ready
+HEADER = struct.Struct('<8Q')
+HEADER_SIZE = 64
+# timestamp (time.monotonic() seconds, 0 for now), status, data1, data2
+RECORD = struct.Struct('<dBBBxxxxx')
+
+HEAD, TAIL, OVERRUNS, HIGH_WATER, SENT, SKIPPED, STOP, READY = range(8)
+
+IDLE = 0.0005
+
+# Controllers sent continuously by MasterGrid, repeated values are dropped
+CONTINUOUS = (1, 2, 4, 11, 91)
+
+
+def droppable(status, data1):
+    # A later message of the same kind supersedes these
+    kind = status & 0xF0
+    return kind in (0xA0, 0xD0, 0xE0) or (kind == 0xB0 and data1 in CONTINUOUS)
+
+
+class MIDIRing:
+    '''Single producer, single consumer ring of MIDI event records.'''
+
+    def __init__(self, capacity=1024, name=None):
+        if capacity & (capacity - 1):
+            raise ValueError('Ring capacity must be a power of two')
+        self.capacity = capacity
+        self.mask = capacity - 1
+        self.headroom = capacity // 4
+        size = HEADER_SIZE + capacity * RECORD.size
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.owner = True
+            self.buf = self.shm.buf
+            self.buf[:HEADER_SIZE] = bytes(HEADER_SIZE)
+        else:
+            # Only the UI process, which created the segment, may unlink it
+            if sys.version_info >= (3, 13):
+                self.shm = shared_memory.SharedMemory(name=name, track=False)
+            else:
+                self.shm = shared_memory.SharedMemory(name=name)
+                resource_tracker.unregister(self.shm._name, 'shared_memory')
+            self.owner = False
+            self.buf = self.shm.buf
+        self.name = self.shm.name
+
+    def get(self, field):
+        return struct.unpack_from('<Q', self.buf, field * 8)[0]
+
+    def put(self, field, value):
+        struct.pack_into('<Q', self.buf, field * 8, value)
+
+    def push(self, timestamp, status, data1=0, data2=0, wait=0.1):
+        head = self.get(HEAD)
+        used = head - self.get(TAIL)
+        if droppable(status, data1):
+            full = used >= self.capacity - self.headroom
+        else:
+            end = time.monotonic() + wait
+            while used >= self.capacity and time.monotonic() < end:
+                time.sleep(IDLE)
+                used = head - self.get(TAIL)
+            full = used >= self.capacity
+        if full:
+            self.put(OVERRUNS, self.get(OVERRUNS) + 1)
+            return False
+        RECORD.pack_into(self.buf, HEADER_SIZE + (head & self.mask) * RECORD.size,
+                         timestamp, status, data1, data2)
+        self.put(HEAD, head + 1)
+        if used + 1 > self.get(HIGH_WATER):
+            self.put(HIGH_WATER, used + 1)
+        return True
+
+    def read(self, index):
+        return RECORD.unpack_from(self.buf, HEADER_SIZE + (index & self.mask) * RECORD.size)
+
+    def occupancy(self):
+        return self.get(HEAD) - self.get(TAIL)
+
+    def stats(self):
+        head, tail, overruns, high_water, sent, skipped, stop, ready = HEADER.unpack_from(self.buf)
+        return {'occupancy': head - tail, 'capacity': self.capacity,
+                'high_water': high_water, 'overruns': overruns,
+                'sent': sent, 'skipped': skipped}
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class MIDIJitter:
+    '''Compares touch event timestamps with the time messages are written.'''
+
+    def __init__(self, latency, recent=10000):
+        self.latency = latency
+        # Running sums cover the whole session, percentiles the recent messages
+        self.count = 0
+        self.total = 0.0
+        self.squares = 0.0
+        self.worst = 0
+        self.delays = collections.deque(maxlen=recent)
+        self.late = 0
+        self.unstamped = 0
+
+    def add(self, timestamp, now):
+        if not timestamp:
+            self.unstamped += 1
+            return
+        delay = now - timestamp
+        self.count += 1
+        self.total += delay
+        self.squares += delay * delay
+        if delay > self.worst:
+            self.worst = delay
+        self.delays.append(delay)
+        if self.latency and delay > self.latency:
+            self.late += 1
+
+    def report(self):
+        if not self.count:
+            return 'MIDI jitter: no timestamped messages'
+        mean = self.total / self.count
+        stdev = max(0, self.squares / self.count - mean * mean) ** .5
+        return ('MIDI jitter: {} messages, latency {} ms\n'
+                '  event to write: mean {:.2f} ms, stdev {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms\n'
+                '  scheduled send: {}, {} late, {} unstamped').format(
+            self.count, self.latency, mean, stdev,
+            sorted(self.delays)[int(len(self.delays) * .99)], self.worst,
+            '{} ms after event'.format(self.latency) if self.latency else 'immediate',
+            self.late, self.unstamped)
+
+
+class PortClock:
+    '''Maps time.monotonic() seconds onto a millisecond clock such as PortMidi's.'''
+
+    def __init__(self, time_ms):
+        # Measure the offset once, right as the millisecond clock ticks, instead
+        # of re-reading and re-quantising both clocks for every message
+        now = time_ms()
+        tick = time_ms()
+        while tick == now:
+            tick = time_ms()
+        self.offset = tick - time.monotonic() * 1000
+
+    def at(self, monotonic):
+        return monotonic * 1000 + self.offset
+
+    def timestamp_for(self, deadline, latency):
+        # Timestamp that sounds at the deadline, PortMidi adds the latency
+        return max(1, int(self.at(deadline)) - latency)
+
+
+class NullOutput:
+    '''Stands in for a MIDI output when no device is given.'''
+
+    def write(self, data):
+        pass
+
+    def write_short(self, status, data1=0, data2=0):
+        pass
+
+    def close(self):
+        pass
+
+
+class SlowOutput(NullOutput):
+    '''Output whose writes block now and then like a busy driver, for benchmarks.'''
+
+    def __init__(self, every, block):
+        self.every = every
+        self.block = block
+        self.count = 0
+
+    def write(self, data):
+        self.write_short(*data[0][0])
+
+    def write_short(self, status, data1=0, data2=0):
+        self.count += 1
+        if not self.count % self.every:
+            time.sleep(self.block)
+
+
+def find_output(name, fallback=True):
+    # Without fallback an unknown name gives None instead of the default output
+    import pygame.midi
+    pygame.midi.init()
+    for i in range(pygame.midi.get_count()):
+        info = pygame.midi.get_device_info(i)
+        if info[1].decode() == name and info[3] == 1:
+            return i
+    return pygame.midi.get_default_output_id() if fallback else None
+
+
+def open_output(device, latency):
+    if device is None:
+        return NullOutput()
+    midi_device = find_output(device)
+    if midi_device < 0:
+        print('Error: No MIDI output device - messages are discarded')
+        return NullOutput()
+    return open_device(midi_device, latency)
+
+
+def open_device(midi_device, latency):
+    import pygame.midi
+    if pygame.midi.get_device_info(midi_device)[4] == 1:
+        print('Error: Unable to open MIDI device - Already in use!')
+    return pygame.midi.Output(midi_device, latency=latency)
+
+
+def port_time():
+    import pygame.midi
+    return pygame.midi.time()
+
+
+class ExpressionState:
+    '''Last value of each continuous message, so repeats can be dropped.'''
+
+    def __init__(self):
+        self.values = {}
+
+    def changed(self, status, data1, data2):
+        kind = status & 0xF0
+        if kind == 0x90:
+            # A new note starts without pressure
+            channel = status & 0x0F
+            self.values.pop((0xD0 | channel, 0), None)
+            self.values.pop((0xA0 | channel, data1), None)
+            return True
+        if kind == 0xB0 and data1 not in CONTINUOUS:
+            return True
+        if kind not in (0xA0, 0xB0, 0xD0, 0xE0):
+            return True
+        # Poly aftertouch and controllers carry their value in data2, keyed by
+        # note or controller; channel pressure and pitchbend start in data1
+        if kind in (0xA0, 0xB0):
+            key, value = (status, data1), data2
+        elif kind == 0xD0:
+            key, value = (status, 0), data1
+        else:
+            key, value = (status, 0), data2 << 7 | data1
+        if self.values.get(key) == value:
+            return False
+        self.values[key] = value
+        return True
+
+
+def run(name, capacity, device, latency, jitterlog, slow=None, skip=True):
+    ring = MIDIRing(capacity, name)
+    if slow is not None:
+        output = SlowOutput(*slow)
+    else:
+        output = open_output(device, latency)
+    clock = port_time if device is not None else (lambda: time.monotonic() * 1000)
+    port = PortClock(clock)
+    state = ExpressionState()
+    jitter = MIDIJitter(latency) if jitterlog else None
+    sent = skipped = 0
+    tail = ring.get(TAIL)
+    ring.put(READY, 1)
+    try:
+        while True:
+            stopping = ring.get(STOP)
+            head = ring.get(HEAD)
+            if head == tail:
+                if stopping:
+                    break
+                time.sleep(IDLE)
+                continue
+            while tail != head:
+                timestamp, status, data1, data2 = ring.read(tail)
+                tail += 1
+                if skip and not state.changed(status, data1, data2):
+                    skipped += 1
+                    continue
+                if timestamp:
+                    now = clock()
+                    stamp = port.at(timestamp)
+                    if jitter is not None:
+                        jitter.add(stamp, now)
+                    if latency:
+                        output.write([[[status, data1, data2], max(1, int(stamp))]])
+                    else:
+                        output.write_short(status, data1, data2)
+                else:
+                    output.write_short(status, data1, data2)
+                sent += 1
+            ring.put(TAIL, tail)
+            ring.put(SENT, sent)
+            ring.put(SKIPPED, skipped)
+    finally:
+        if jitter is not None:
+            print(jitter.report())
+        output.close()
+        ring.close()
+
+
+class Engine:
+    '''Runs the engine script as a child process draining the given ring.'''
+
+    def __init__(self, ring, device, latency=0, jitterlog=False, slow=None, skip=True):
+        self.ring = ring
+        args = [sys.executable, os.path.abspath(__file__), ring.name, str(ring.capacity),
+                '--latency', str(latency)]
+        if device is not None:
+            args += ['--device', device]
+        if jitterlog:
+            args.append('--jitterlog')
+        if slow is not None:
+            args += ['--slow', '{}:{}'.format(*slow)]
+        if not skip:
+            args.append('--no-skip')
+        self.process = subprocess.Popen(args)
+
+    def wait_ready(self, timeout=10):
+        # False if the engine exited or did not come up in time
+        end = time.monotonic() + timeout
+        while not self.ring.get(READY):
+            if not self.alive() or time.monotonic() > end:
+                return False
+            time.sleep(IDLE)
+        return self.alive()
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def stop(self):
+        self.ring.put(STOP, 1)
+        try:
+            self.process.wait(1)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MasterGrid MIDI engine')
+    parser.add_argument('ring', help='shared memory name of the ring')
+    parser.add_argument('capacity', type=int, help='ring capacity in records')
+    parser.add_argument('--device', help='MIDI output name, no output if omitted')
+    parser.add_argument('--latency', type=int, default=0, help='output latency in milliseconds')
+    parser.add_argument('--jitterlog', action='store_true', help='print timing statistics on exit')
+    parser.add_argument('--slow', metavar='EVERY:SECONDS',
+                        help='benchmark output that blocks every so many writes instead of a device')
+    parser.add_argument('--no-skip', dest='skip', action='store_false',
+                        help='send repeated controller values too')
+    args = parser.parse_args()
+    slow = None
+    if args.slow:
+        every, block = args.slow.split(':')
+        slow = (int(every), float(block))
+    run(args.ring, args.capacity, args.device, args.latency, args.jitterlog, slow, args.skip)
+
+
+if __name__ == '__main__':
+    main()
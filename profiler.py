@@ -0,0 +1,118 @@
+'''
+MasterGrid
+Copyright (c) 2018 Robert Oscilowski
+
+Sampling profiler
+
+A background thread samples the call stack of the UI thread at a fixed
+interval. Samples are aggregated per frame, frames slower than the budget
+keep their own stacks, and both are written as collapsed stacks
+("a;b;c count" lines) for flame graph tools such as flamegraph.pl or speedscope.
+
+MasterGrid is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MasterGrid is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MasterGrid. If not, see <http://www.gnu.org/licenses/>
+'''
+
+import collections
+import heapq
+import os
+import sys
+import threading
+import time
+
+
+def enabled(value):
+    return value is not None and value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def collapse(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename),
+                                         code.co_firstlineno))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Profiler:
+    '''Samples one thread and aggregates its stacks per frame.'''
+
+    def __init__(self, thread_id=None, interval=0.002, budget=20, keep=50):
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.interval = interval
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.frame = collections.Counter()
+        self.total = collections.Counter()
+        # The slowest frames over budget, as a min-heap of (duration, number, stacks)
+        self.keep = keep
+        self.slow = []
+        self.over = 0
+        self.frames = 0
+        self.last = None
+        self.sampler = None
+
+    def start(self):
+        self.sampler = threading.Thread(target=self.run, name='MasterGrid profiler', daemon=True)
+        self.sampler.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = collapse(frame)
+            with self.lock:
+                self.frame[stack] += 1
+
+    def frame_end(self, *args):
+        # Called once per frame on the profiled thread
+        now = time.perf_counter()
+        with self.lock:
+            frame, self.frame = self.frame, collections.Counter()
+        self.total.update(frame)
+        self.frames += 1
+        if self.last is not None:
+            duration = (now - self.last) * 1000
+            if duration > self.budget and frame:
+                self.over += 1
+                if len(self.slow) < self.keep:
+                    heapq.heappush(self.slow, (duration, self.frames, frame))
+                elif duration > self.slow[0][0]:
+                    heapq.heapreplace(self.slow, (duration, self.frames, frame))
+        self.last = now
+
+    def stop(self):
+        self.stopped.set()
+        if self.sampler is not None:
+            self.sampler.join()
+
+    def write(self, directory):
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        profile = os.path.join(directory, 'profile-{}.collapsed'.format(stamp))
+        with open(profile, 'w') as f:
+            for stack, count in self.total.most_common():
+                f.write('{} {}\n'.format(stack, count))
+        slow = os.path.join(directory, 'slow-frames-{}.collapsed'.format(stamp))
+        with open(slow, 'w') as f:
+            for duration, number, frame in sorted(self.slow, key=lambda slow: slow[1]):
+                root = 'frame {} ({:.1f} ms)'.format(number, duration)
+                for stack, count in frame.most_common():
+                    f.write('{};{} {}\n'.format(root, stack, count))
+        return profile, slow
+
+    def report(self):
+        return 'Profiler: {} frames, {} over {} ms, {} slowest kept, {} samples'.format(
+            self.frames, self.over, self.budget, len(self.slow), sum(self.total.values()))
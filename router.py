@@ -0,0 +1,233 @@
+'''
+MasterGrid
+Copyright (c) 2018 Robert Oscilowski
+
+MIDI fan-out router
+
+Sends each message to several MIDI destinations, filtered by channel and
+note range. Every destination has its own bounded queue and writer thread,
+so a slow or blocked output does not hold up the others. Routing rules are
+compiled once into lookup tables indexed by channel and note.
+
+Destinations are configured as a string, entries separated by '|':
+
+    name, channels, notes, policy
+
+where channels and notes are 'all', a single number or a range like '0-3',
+and policy is 'drop' (drop new messages when the queue is full), 'oldest'
+(drop the oldest queued message) or 'block' (wait up to 50 ms for room, then
+carry on as 'drop' until the destination sends again). Dispatch never waits
+longer than that for a destination.
+When a queue is full, continuous controller, pitchbend and aftertouch messages
+are dropped first. A note-on that still finds no room is dropped together
+with its note-off. Note-offs and resets always go into the queue, past its
+bound if need be.
+
+The writer threads only isolate slowness that releases the interpreter.
+pygame's PortMidi binding holds the GIL while writing, so a driver that blocks
+inside a write stalls every thread. The MIDI engine process (midiengine.py)
+keeps such a driver away from the UI.
+
+MasterGrid is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MasterGrid is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MasterGrid. If not, see <http://www.gnu.org/licenses/>
+'''
+
+import collections
+import threading
+import time
+
+import midiengine
+from midiengine import droppable
+
+POLICIES = ('drop', 'oldest', 'block')
+
+# Longest wait for room under the block policy, in seconds
+BLOCK = 0.05
+
+
+def parse_range(text, high):
+    text = text.strip()
+    if text in ('', 'all'):
+        return range(high + 1)
+    low, _, top = text.partition('-')
+    low = int(low)
+    top = int(top) if top else low
+    if not 0 <= low <= top <= high:
+        raise ValueError('{} is outside 0-{}'.format(text, high))
+    return range(low, top + 1)
+
+
+def parse_destinations(text):
+    destinations = []
+    for entry in text.split('|'):
+        if not entry.strip():
+            continue
+        fields = [field.strip() for field in entry.split(',')] + ['', '', '']
+        name, channels, notes, policy = fields[:4]
+        try:
+            policy = policy or 'drop'
+            if policy not in POLICIES:
+                raise ValueError('unknown policy {}'.format(policy))
+            destinations.append((name, set(parse_range(channels, 15)),
+                                 set(parse_range(notes, 127)), policy))
+        except ValueError as e:
+            print('Error: Ignoring MIDI destination "{}" - {}'.format(entry.strip(), e))
+    return destinations
+
+
+class Destination:
+    '''One MIDI output with its own queue and writer thread.'''
+
+    def __init__(self, name, output, channels, notes, policy='drop', size=256):
+        self.name = name
+        self.output = output
+        self.channels = channels
+        self.notes = notes
+        self.policy = policy
+        self.size = size
+        self.queue = collections.deque()
+        self.ready = threading.Condition()
+        # Channel and note of note-ons dropped for lack of room
+        self.silenced = set()
+        self.stalled = False
+        self.sent = 0
+        self.dropped = 0
+        self.high_water = 0
+        self.delay_total = 0.0
+        self.delay_max = 0.0
+        self.writer = threading.Thread(target=self.run, name='MIDI ' + name, daemon=True)
+        self.writer.start()
+
+    def put(self, message):
+        with self.ready:
+            if self.policy == 'block' and not self.stalled:
+                self.stalled = not self.ready.wait_for(lambda: len(self.queue) < self.size, BLOCK)
+            if not self.admit(message[2], message[3], message[4]):
+                self.dropped += 1
+                return
+            self.queue.append(message)
+            if len(self.queue) > self.high_water:
+                self.high_water = len(self.queue)
+            self.ready.notify_all()
+
+    def admit(self, status, data1, data2):
+        kind = status & 0xF0
+        note = (status & 0x0F, data1)
+        if kind == 0x80 or (kind == 0x90 and not data2):
+            if note in self.silenced:
+                # Its note-on was dropped
+                self.silenced.discard(note)
+                return False
+            return True
+        if len(self.queue) < self.size:
+            if kind == 0x90:
+                self.silenced.discard(note)
+            return True
+        if droppable(status, data1):
+            return self.policy == 'oldest' and self.drop_oldest()
+        if kind == 0x90:
+            if self.drop_oldest():
+                self.silenced.discard(note)
+                return True
+            self.silenced.add(note)
+            return False
+        # Resets and the like go past the bound rather than wait
+        self.drop_oldest()
+        return True
+
+    def drop_oldest(self):
+        for i, queued in enumerate(self.queue):
+            if droppable(queued[2], queued[3]):
+                del self.queue[i]
+                self.dropped += 1
+                return True
+        return False
+
+    def run(self):
+        while True:
+            with self.ready:
+                while not self.queue:
+                    self.ready.wait()
+                message = self.queue.popleft()
+                self.stalled = False
+                self.ready.notify_all()
+            if message is None:
+                break
+            queued, timestamp, status, data1, data2 = message
+            if timestamp:
+                self.output.write([[[status, data1, data2], timestamp]])
+            else:
+                self.output.write_short(status, data1, data2)
+            delay = time.perf_counter() - queued
+            self.delay_total += delay
+            if delay > self.delay_max:
+                self.delay_max = delay
+            self.sent += 1
+        self.output.close()
+
+    def close(self):
+        with self.ready:
+            self.queue.append(None)
+            self.ready.notify_all()
+        self.writer.join(1)
+
+    def report(self):
+        mean = self.delay_total / self.sent * 1000 if self.sent else 0
+        return '  {}: {} sent, {} dropped, queue high water {}, delay mean {:.2f} ms, max {:.2f} ms'.format(
+            self.name, self.sent, self.dropped, self.high_water, mean, self.delay_max * 1000)
+
+
+class Router:
+    '''Fans MIDI messages out to destinations through precompiled lookup tables.'''
+
+    def __init__(self, destinations, latency=0, size=256):
+        self.destinations = []
+        devices = set()
+        for name, channels, notes, policy in destinations:
+            device = midiengine.find_output(name, fallback=False)
+            if device is None or device in devices:
+                reason = 'no such output device' if device is None else 'device listed twice'
+                print('Error: Ignoring MIDI destination "{}" - {}'.format(name, reason))
+                continue
+            devices.add(device)
+            self.destinations.append(Destination(name, midiengine.open_device(device, latency),
+                                                 channels, notes, policy, size))
+        self.compile()
+
+    def compile(self):
+        # Channel messages route by channel, note messages by channel and note
+        self.by_channel = [tuple(d for d in self.destinations if channel in d.channels)
+                           for channel in range(16)]
+        self.by_note = [tuple(d for d in self.by_channel[channel] if note in d.notes)
+                        for channel in range(16) for note in range(128)]
+        self.everyone = tuple(self.destinations)
+
+    def dispatch(self, timestamp, status, data1=0, data2=0):
+        kind = status & 0xF0
+        if kind in (0x80, 0x90, 0xA0):
+            targets = self.by_note[(status & 0x0F) << 7 | data1]
+        elif kind == 0xF0:
+            targets = self.everyone
+        else:
+            targets = self.by_channel[status & 0x0F]
+        if targets:
+            message = (time.perf_counter(), timestamp, status, data1, data2)
+            for destination in targets:
+                destination.put(message)
+
+    def close(self):
+        for destination in self.destinations:
+            destination.close()
+
+    def report(self):
+        return '\n'.join(['MIDI router:'] + [d.report() for d in self.destinations])
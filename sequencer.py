@@ -0,0 +1,197 @@
+'''
+MasterGrid
+Copyright (c) 2018 Robert Oscilowski
+
+Arpeggiator and latch sequencer
+
+Notes are timed by a dedicated thread against absolute deadlines, so tempo
+does not drift with the frame rate like Kivy's Clock.schedule_interval.
+Messages are handed to the MIDI backend a lookahead ahead of their deadline,
+stamped with the time they should sound. The lookahead is the output latency
+plus a margin, so a late wake up within the margin still sounds on time.
+Without an output latency the timestamps are ignored and the lookahead is 0.
+
+MasterGrid is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MasterGrid is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MasterGrid. If not, see <http://www.gnu.org/licenses/>
+'''
+
+import collections
+import heapq
+import random
+import statistics
+import threading
+import time
+
+# Sleep until this close to a deadline, then spin
+SPIN = 0.001
+
+
+class Sequencer(threading.Thread):
+    '''Plays held (Arp) or latched (Latch) notes in time with the tempo.'''
+
+    def __init__(self, midi, channel=0, mode='Off', pattern='Up',
+                 bpm=120, rate=4, swing=0, gate=50, lookahead=0):
+        super().__init__(name='MasterGrid sequencer', daemon=True)
+        self.midi = midi
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.held = {}
+        self.latched = []
+        self.events = []
+        self.errors = collections.deque(maxlen=10000)
+        self.configure(channel=channel, mode=mode, pattern=pattern, bpm=bpm,
+                       rate=rate, swing=swing, gate=gate, lookahead=lookahead)
+
+    def configure(self, **kwargs):
+        with self.lock:
+            for key, value in kwargs.items():
+                setattr(self, key, value)
+            if self.mode != 'Latch':
+                self.latched = []
+            self.restart = True
+        self.wakeup.set()
+
+    @property
+    def active(self):
+        return self.mode != 'Off'
+
+    def step_length(self):
+        return 60.0 / self.bpm / self.rate
+
+    def press(self, uid, note, velocity):
+        with self.lock:
+            if self.mode == 'Latch':
+                for latched in self.latched:
+                    if latched[0] == note:
+                        self.latched.remove(latched)
+                        break
+                else:
+                    self.latched.append((note, int(velocity)))
+            else:
+                self.held[uid] = (note, int(velocity))
+        self.wakeup.set()
+
+    def release(self, uid):
+        with self.lock:
+            self.held.pop(uid, None)
+
+    def clear(self):
+        with self.lock:
+            self.held.clear()
+            self.latched = []
+
+    def notes(self):
+        if self.mode == 'Latch':
+            return list(self.latched)
+        notes = sorted(set(self.held.values()))
+        if self.pattern == 'Down':
+            notes.reverse()
+        elif self.pattern == 'UpDown' and len(notes) > 2:
+            notes += notes[-2:0:-1]
+        elif self.pattern == 'Random':
+            random.shuffle(notes)
+        return notes
+
+    def deadline(self, start, step):
+        length = self.step_length()
+        # Swing delays every second step by a fraction of a step
+        swing = length * self.swing / 100.0 if step % 2 else 0
+        return start + step * length + swing
+
+    def wait(self, until):
+        while True:
+            remaining = until - time.monotonic()
+            if remaining <= 0 or self.stopped:
+                return
+            if remaining > SPIN:
+                self.wakeup.wait(remaining - SPIN)
+                if self.wakeup.is_set():
+                    return
+            # Spin out the last stretch, sleep granularity is too coarse for it
+
+    def send(self, deadline, status, data1, data2):
+        self.midi.write_at(self.midi.timestamp_for(deadline), status, data1, data2)
+        self.errors.append(time.monotonic() - (deadline - self.lookahead))
+
+    def flush(self):
+        # Release sounding notes right away, e.g. when the tempo changes. Note-ons
+        # already handed over sound up to one lookahead from now, release after them.
+        release = self.midi.timestamp_for(time.monotonic() + self.lookahead)
+        while self.events:
+            deadline, status, data1, data2 = heapq.heappop(self.events)
+            if status & 0xF0 == 0x80:
+                self.midi.write_at(release, status, data1, data2)
+
+    def run(self):
+        step = 0
+        start = None
+        while not self.stopped:
+            self.wakeup.clear()
+            with self.lock:
+                restart = self.restart or not self.active
+                if restart:
+                    self.restart = False
+                    step = 0
+                    start = time.monotonic() + self.lookahead
+                if not self.active:
+                    start = None
+                next_step = self.deadline(start, step) if start is not None else None
+            # Only this thread touches the events, write without holding the lock
+            # so a blocking MIDI destination cannot stall press() on the UI thread
+            if restart:
+                self.flush()
+
+            if self.events and (next_step is None or self.events[0][0] <= next_step):
+                due = self.events[0][0]
+            elif next_step is not None:
+                due = next_step
+            else:
+                self.wakeup.wait()
+                continue
+
+            self.wait(due - self.lookahead)
+            if self.wakeup.is_set() or self.stopped:
+                continue
+
+            if self.events and self.events[0][0] == due:
+                self.send(*heapq.heappop(self.events))
+                continue
+
+            with self.lock:
+                notes = self.notes()
+                length = self.step_length()
+                gate = length * self.gate / 100.0
+                channel = self.channel
+            if notes:
+                note, velocity = notes[step % len(notes)]
+                self.send(due, 0x90 + channel, note, velocity)
+                heapq.heappush(self.events, (due + gate, 0x80 + channel, note, 0))
+            step += 1
+        self.flush()
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+
+    def report(self):
+        if not self.errors:
+            return 'Sequencer timing: no notes sent'
+        errors = sorted(e * 1000 for e in self.errors)
+        # A message is late once its timestamp has passed, PortMidi then sends it right away
+        margin = max(0, self.lookahead * 1000 - self.midi.latency)
+        late = sum(1 for e in errors if e > margin)
+        return ('Sequencer timing: {} messages, lookahead {:.0f} ms, {} late\n'
+                '  wake error: mean {:.3f} ms, stdev {:.3f} ms, p99 {:.3f} ms, max {:.3f} ms').format(
+            len(errors), self.lookahead * 1000, late, statistics.mean(errors), statistics.pstdev(errors),
+            errors[int(len(errors) * .99)], errors[-1])